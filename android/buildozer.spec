@@ -10,6 +10,7 @@ package.name = shuffleupagus
 package.domain = org.emenendez
 
 # (str) Source code where the main.py live
+# shuffleupagus/ is a symlink to ../shuffleupagus; buildozer (>= 1.2) follows symlinks when copying sources
 source.dir = .
 
 # (list) Source files to include (let empty to include all the files)
@@ -36,7 +37,7 @@ version = 0.1
 
 # (list) Application requirements
 # comma separated e.g. requirements = sqlite3,kivy
-requirements = python3,kivy,appdirs==1.4.4,certifi==2020.12.5,chardet==4.0.0,click==7.1.2,Cython==0.29.23,docutils==0.17.1,Flask==1.1.4,idna==2.10,importlib-metadata==4.2.0,itsdangerous==1.1.0,Jinja2==2.11.3,MarkupSafe==2.0.1,mutagen==1.45.1,pep517==0.6.0,pytoml==0.1.21,requests==2.25.1,sh==1.14.2,six==1.16.0,toml==0.10.2,urllib3==1.26.5,Werkzeug==1.0.1,zipp==3.4.1
+requirements = python3,kivy,appdirs==1.4.4,certifi==2020.12.5,chardet==4.0.0,click==7.1.2,Cython==0.29.23,docutils==0.17.1,Flask==1.1.4,Flask-Caching==1.10.1,idna==2.10,importlib-metadata==4.2.0,itsdangerous==1.1.0,Jinja2==2.11.3,MarkupSafe==2.0.1,mutagen==1.45.1,pep517==0.6.0,pytoml==0.1.21,requests==2.25.1,sh==1.14.2,six==1.16.0,toml==0.10.2,urllib3==1.26.5,waitress==2.0.0,Werkzeug==1.0.1,zipp==3.4.1
 
 # (str) Custom source folders for requirements
 # Sets custom source for any requirements with recipes
@@ -1,9 +1,8 @@
-import re
-from pathlib import Path
+import json
+import logging
 import time
 import typing as t
-from logging import Logger
-from multiprocessing import Process
+from threading import Thread
 
 from kivy.app import App
 from kivy.uix.checkbox import CheckBox
@@ -15,15 +14,26 @@ from kivy.uix.screenmanager import ScreenManager, Screen
 
 from android.permissions import check_permission, Permission, request_permissions
 
-from flask import abort, Flask, request, send_file
-from mutagen.easyid3 import EasyID3
-from mutagen.mp3 import MP3
+from flask import abort, Flask, request, Response
+from flask_caching import Cache
+from waitress import create_server, wasyncore
 
 from config import MUSIC_DIR, USERNAME, PASSWORD, PLAYLIST_NAME, PLAYLIST_ID
-from pocketcasts import pocket_casts, Episode, download_episode
+from shuffleupagus.core import (
+    download_episode, download_session, Episode, playlist_filenames, pocket_casts, send_episode, STAGING_PREFIX,
+    tag_episode,
+)
 
 
+log = logging.getLogger(__name__)
+
+# Route waitress' logs through kivy's handlers
+waitress_log = logging.getLogger('waitress')
+waitress_log.handlers = logging.getLogger('kivy').handlers
+waitress_log.propagate = False
+
 app = Flask(__name__)
+cache = Cache(app, config={"CACHE_TYPE": "SimpleCache"})
 PERMISSIONS = [Permission.ACCESS_NETWORK_STATE, Permission.INTERNET, Permission.WRITE_EXTERNAL_STORAGE]
 episodes = []
 
@@ -38,25 +48,27 @@ def auth(f):
     return inner
 
 
+SUBSONIC_STATUS = {
+    "status": "ok",
+    "version": "1.10.2",
+}
+EMPTY_RESPONSE = json.dumps({"subsonic-response": SUBSONIC_STATUS})
+
+
 def make_response(dict):
-    response = {
-      "subsonic-response": {
-            "status": "ok",
-            "version": "1.10.2",
-        },
+    return {
+        "subsonic-response": {**SUBSONIC_STATUS, **dict},
     }
-    response["subsonic-response"].update(dict)
-    return response
 
 
 @app.route('/rest/ping')
 def ping():
-    return make_response({})
+    return Response(EMPTY_RESPONSE, mimetype="application/json")
 
 
 @app.route('/rest/scrobble')
 def scrobble():
-    return make_response({})
+    return Response(EMPTY_RESPONSE, mimetype="application/json")
 
 
 @app.route('/rest/getPlaylists')
@@ -75,6 +87,7 @@ def get_playlists():
 
 
 @app.route('/rest/getPlaylist')
+@cache.cached(timeout=300, query_string=True)
 def get_playlist():
     playlist_id = request.args.get('id')
     if not playlist_id:
@@ -106,7 +119,7 @@ def stream():
     if not episode_id:
         abort(400)
 
-    return send_file(episodes[episode_id].path)
+    return send_episode(episodes[episode_id], request)
 
 
 class EpisodeWidget(Label):
@@ -130,9 +143,10 @@ class EpisodeWidget(Label):
 
 class SyncLayout(BoxLayout):
 
-    def __init__(self, episodes_from_pocketcasts, **kwargs):
+    def __init__(self, episodes_from_pocketcasts, titles_by_uuid, **kwargs):
         super(SyncLayout, self).__init__(**kwargs)
         self.orientation = 'vertical'
+        self.titles_by_uuid = titles_by_uuid
 
         selected = False
         for episode in episodes_from_pocketcasts:
@@ -158,16 +172,20 @@ class SyncLayout(BoxLayout):
         }
 
         # Get previously-downloaded files
-        ipod_by_uuid: t.Dict[str, Path] = {}
+        ipod_by_uuid: t.Dict[str, str] = {}
         playlist_path = MUSIC_DIR
         playlist_path.mkdir(parents=True, exist_ok=True)
-        filename_regex = re.compile(r"([a-f0-9-]+)\..+")
-        for file in playlist_path.iterdir():
-            filename_match = filename_regex.match(file.name)
-            if not filename_match:
-                log.error("Cannot parse filename %s", file)
+        for filename in playlist_filenames(playlist_path):
+            if filename.startswith("."):
+                # Clean up after downloads that were interrupted mid-sync
+                if filename.startswith(STAGING_PREFIX):
+                    (playlist_path / filename).unlink()
+                continue
+            uuid = Episode.uuid_from_filename(filename)
+            if not uuid:
+                log.error("Cannot parse filename %s", filename)
                 continue
-            ipod_by_uuid[filename_match.group(1)] = file
+            ipod_by_uuid[uuid] = filename
 
 
         uuids_on_ipod = set(ipod_by_uuid.keys())
@@ -177,47 +195,52 @@ class SyncLayout(BoxLayout):
         uuids_to_download = uuids_from_pocketcasts - uuids_on_ipod
 
         for uuid in uuids_to_delete:
-            ipod_by_uuid[uuid].unlink()
+            (playlist_path / ipod_by_uuid[uuid]).unlink()
 
         episodes_to_download = [pocketcasts_by_uuid[uuid] for uuid in uuids_to_download]
 
         # Download episodes
         self.btn.text = "Downloading"
-        for success, episode in (download_episode(e) for e in episodes_to_download):
-            if success:
-                tags = EasyID3(episode.path)
-                tags["title"] = episode.title
-                tags["genre"] = "Podcast"
-                try:
-                    tags["album"] = titles_by_uuid[episode.podcast]
-                except KeyError:
-                    tags["album"] = "Mystery podcast"
-                tags.save()
+        with download_session() as session:
+            for success, episode in (download_episode(session, e) for e in episodes_to_download):
+                if success:
+                    tag_episode(episode, self.titles_by_uuid.get(episode.podcast, "Mystery podcast"))
 
         global episodes
         episodes = pocketcasts_by_uuid
+        cache.clear()
 
         # Prompt to start flask
         self.btn.text = "Serve"
         self.btn.unbind(on_press=self.download_episodes)
-        self.btn.bind(on_press=self.start_process)
+        self.btn.bind(on_press=self.start_server)
 
-    def start_process(self, instance):
+    def start_server(self, instance):
         self.btn.text = "Serving"
-        self.btn.unbind(on_press=self.start_process)
-        self.btn.bind(on_press=self.stop_process)
-        self.process = Process(target=self.serve)
-        self.process.daemon = True
-        self.process.start()
+        self.btn.unbind(on_press=self.start_server)
+        self.btn.bind(on_press=self.stop_server)
 
-    def stop_process(self, instance):
-        self.process.terminate()
-
-    def serve(self):
         # Start flask
         print("Starting flask...")
-        Logger.manager.loggerDict['werkzeug'] = Logger.manager.loggerDict['kivy']
-        app.run(host='0.0.0.0', port=5000)
+        self.server = create_server(app, host='0.0.0.0', port=5000, threads=4)
+        self.server_thread = Thread(target=self.server.run, daemon=True)
+        self.server_thread.start()
+
+    def stop_server(self, instance):
+        self.btn.text = "Stopping"
+        self.btn.unbind(on_press=self.stop_server)
+
+        # waitress' socket map isn't thread-safe, so close it from the server thread
+        self.server.trigger.pull_trigger(self.close_server)
+        self.server_thread.join()
+
+        self.btn.text = "Serve"
+        self.btn.bind(on_press=self.start_server)
+
+    def close_server(self):
+        self.server.task_dispatcher.shutdown()
+        # Emptying the map ends the loop in server.run()
+        wasyncore.close_all(self.server._map)
 
 
 class SyncApp(App):
@@ -228,7 +251,7 @@ class SyncApp(App):
             print("Waiting for permissions...")
             time.sleep(1)
 
-        with pocket_casts() as api:
+        with pocket_casts(USERNAME, PASSWORD, MUSIC_DIR) as api:
             # Get all podcast titles
             titles_by_uuid: t.Dict[str, str] = api.podcasts()
 
@@ -238,6 +261,7 @@ class SyncApp(App):
             # Create download screen
             return SyncLayout(
                 episodes_from_pocketcasts,
+                titles_by_uuid,
             )
 
 
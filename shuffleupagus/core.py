@@ -0,0 +1,276 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import cached_property
+import json
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import time
+import typing as t
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import requests
+from flask import Request, Response, send_file
+from mutagen.easyid3 import EasyID3
+from mutagen.id3 import ID3NoHeaderError
+from mutagen.mp3 import MP3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+# Optional libraries (not available on Android)
+try:
+    import ffmpeg
+except ImportError:
+    ffmpeg = None
+
+try:
+    import keyring
+except ImportError:
+    keyring = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+log = logging.getLogger(__name__)
+
+TOKEN_LIFETIME = 60 * 60
+
+# Hidden, so an interrupted download never looks like an episode
+STAGING_PREFIX = ".shuffleupagus-"
+
+FILENAME_REGEX = re.compile(r"([a-f0-9-]+)\..+")
+UUID_CHARS = frozenset("0123456789abcdef-")
+
+
+@dataclass(frozen=True)
+class Episode:
+    order: int
+    uuid: str
+    url: str
+    title: str
+    podcast: str
+    music_dir: Path = field(repr=False, compare=False)
+
+    @classmethod
+    def from_dict(cls, order: int, dict: t.Dict, music_dir: Path) -> "Episode":
+        return cls(
+            order=order,
+            uuid=str(dict["uuid"]),
+            url=str(dict["url"]),
+            title=str(dict["title"]),
+            podcast=str(dict["podcast"]),
+            music_dir=music_dir,
+        )
+
+    @staticmethod
+    def uuid_from_filename(filename: str) -> t.Optional[str]:
+        # Episodes are saved as "{uuid}{extension}", so skip the regex for canonical UUIDs
+        if len(filename) > 37 and filename[36] == "." and \
+                filename[8] == filename[13] == filename[18] == filename[23] == "-":
+            uuid = filename[:36]
+            # Same characters the regex accepts, so both paths agree on what is an episode
+            if UUID_CHARS.issuperset(uuid):
+                return uuid
+            return None
+        filename_match = FILENAME_REGEX.match(filename)
+        return filename_match.group(1) if filename_match else None
+
+    @cached_property
+    def extension(self) -> str:
+        return Path(urlsplit(self.url).path).suffix
+
+    @cached_property
+    def filename(self) -> str:
+        return f"{self.uuid}{self.extension}"
+
+    @cached_property
+    def path(self) -> Path:
+        return self.music_dir / self.filename
+
+    @cached_property
+    def partial_path(self) -> Path:
+        return self.path.with_name(f"{STAGING_PREFIX}{self.uuid}.partial{self.extension}")
+
+    @cached_property
+    def duration(self) -> int:
+        return int(MP3(self.path).info.length)
+
+
+@dataclass
+class PocketCasts:
+    session: requests.Session
+    username: str
+    password: str
+    music_dir: Path
+
+    def authorize(self, token: str) -> None:
+        self.session.headers.update({"Authorization": f"Bearer {token}"})
+
+    def login(self) -> None:
+        with self.session.post('https://api.pocketcasts.com/user/login',
+                               json={"email": self.username, "password": self.password}) as response:
+            token = json_loads(response.content)["token"]
+        if keyring:
+            cached = {"token": token, "expires_at": time.time() + TOKEN_LIFETIME}
+            keyring.set_password("Pocket Casts", token_key(self.username), json.dumps(cached))
+        self.authorize(token)
+
+    def json(self, method: str, *args, **kwargs) -> t.Dict:
+        method_call = getattr(self.session, method)
+        with method_call(*args, **kwargs) as response:
+            if response.status_code != 401:
+                return json_loads(response.content)
+
+        # Cached token was revoked or expired early
+        self.login()
+        with method_call(*args, **kwargs) as response:
+            return json_loads(response.content)
+
+    def up_next(self) -> t.List[Episode]:
+        response = self.json("post", "https://api.pocketcasts.com/up_next/list", json={"version": 2})
+        return [Episode.from_dict(order, episode, self.music_dir)
+                for order, episode in enumerate(response["episodes"])]
+
+    def podcasts(self) -> t.Dict[str, str]:
+        response = self.json("post", "https://api.pocketcasts.com/user/podcast/list", json={"v": 1})
+        return {podcast['uuid']: podcast['title'] for podcast in response['podcasts']}
+
+
+def token_key(username: str) -> str:
+    # Tokens are per account, so switching usernames never reuses another account's token
+    return f"token:{username}"
+
+
+def cached_token(username: str) -> t.Optional[str]:
+    if not keyring:
+        return None
+
+    try:
+        cached = json_loads(keyring.get_password("Pocket Casts", token_key(username)) or "null")
+        if cached and cached["expires_at"] > time.time():
+            return cached["token"]
+    except (ValueError, KeyError, TypeError):
+        log.warning("Ignoring malformed cached Pocket Casts token")
+    return None
+
+
+@contextmanager
+def pocket_casts(username: str, password: str, music_dir: Path):
+    with requests.Session() as session:
+        api = PocketCasts(session, username, password, music_dir)
+        if token := cached_token(username):
+            api.authorize(token)
+        else:
+            api.login()
+        yield api
+
+
+def playlist_filenames(playlist_path: Path, use_find: bool = False) -> t.List[str]:
+    # One find call avoids a round-trip per entry on slow or network-mounted devices
+    if use_find:
+        try:
+            result = subprocess.run(
+                ["find", str(playlist_path), "-maxdepth", "1", "-type", "f", "-printf", "%f\\0"],
+                capture_output=True,
+            )
+            if result.returncode == 0:
+                return [os.fsdecode(name) for name in result.stdout.split(b"\0") if name]
+        except (OSError, UnicodeDecodeError):
+            pass
+
+    # No GNU find (macOS, Windows), or a local directory where scandir is cheaper anyway
+    with os.scandir(playlist_path) as entries:
+        return [entry.name for entry in entries if entry.is_file(follow_symlinks=False)]
+
+
+def speedup(input: str, output: str, tempo: float) -> None:
+    if ffmpeg is None:
+        raise RuntimeError("ffmpeg-python is required to change tempo")
+
+    options = {}
+    try:
+        options['audio_bitrate'] = ffmpeg.probe(input)['format']['bit_rate']
+    except Exception:
+        pass
+
+    (
+        ffmpeg.input(input)
+        .audio
+        .filter_('atempo', str(tempo))
+        .output(output, **options)
+        .run(quiet=True)
+    )
+
+
+def tag_episode(episode: Episode, album: str) -> None:
+    try:
+        try:
+            tags = EasyID3(episode.path)
+        except ID3NoHeaderError:
+            # Untouched downloads (no ffmpeg pass) may not have an ID3 header yet
+            tags = EasyID3()
+        tags.update({"title": episode.title, "genre": "Podcast", "album": album})
+        tags.save(episode.path)
+    except Exception:
+        log.exception("Could not rename %r", episode)
+
+
+def send_episode(episode: Episode, request: Request) -> Response:
+    # Downloaded files never change, so the episode UUID is a stable ETag
+    response = send_file(episode.path, conditional=False, add_etags=False)
+    response.set_etag(episode.uuid)
+    try:
+        return response.make_conditional(request, accept_ranges=True,
+                                         complete_length=os.path.getsize(episode.path))
+    except RequestedRangeNotSatisfiable:
+        response.close()
+        raise
+
+
+def download_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                          max_retries=Retry(total=3, backoff_factor=0.3))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+@contextmanager
+def staging_file(episode: Episode) -> t.Iterator[t.IO[bytes]]:
+    # Stage next to the final path so os.replace is a rename rather than a cross-filesystem copy;
+    # anything not moved into place by the end of the block is removed
+    temp_file = tempfile.NamedTemporaryFile(dir=episode.music_dir, prefix=STAGING_PREFIX, delete=False)
+    try:
+        yield temp_file
+    finally:
+        temp_file.close()
+        for leftover in (temp_file.name, episode.partial_path):
+            try:
+                os.unlink(leftover)
+            except OSError:
+                pass
+
+
+def download_episode(session: requests.Session, episode: Episode) -> t.Tuple[bool, Episode]:
+    try:
+        with session.get(episode.url, stream=True) as response:
+            response.raise_for_status()
+            with staging_file(episode) as temp_file:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    temp_file.write(chunk)
+                temp_file.close()
+                os.replace(temp_file.name, episode.path)
+
+    except Exception:
+        log.exception("Error downloading %s", episode.url)
+        return False, episode
+
+    return True, episode
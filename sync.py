@@ -1,30 +1,30 @@
-from contextlib import contextmanager
-from dataclasses import dataclass, fields
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import ExitStack
 from functools import wraps
 import logging
 import os
-import re
-import tempfile
 import typing as t
-from functools import partial
-from multiprocessing.pool import ThreadPool
 from pathlib import Path
+from urllib.parse import urlsplit
 
+import aiohttp
 import click
-import ffmpeg
 import inquirer
 import keyring
-import requests
-from flask import abort, Flask, request, send_file
-from furl import furl
-from mutagen.easyid3 import EasyID3
-from mutagen.mp3 import MP3
+import orjson
+from flask import abort, Flask, request, Response
+from flask_caching import Cache
 from rich.logging import RichHandler
 
 from ipod import Shuffler
+from shuffleupagus.core import (
+    Episode, playlist_filenames, pocket_casts, send_episode, speedup, STAGING_PREFIX, staging_file, tag_episode,
+)
 
 
 app = Flask(__name__)
+cache = Cache(app, config={"CACHE_TYPE": "SimpleCache"})
 
 logging.basicConfig(
     level="INFO",
@@ -42,107 +42,77 @@ USERNAME = keyring.get_credential("Pocket Casts", "username").password
 PASSWORD = keyring.get_credential("Pocket Casts", USERNAME).password
 
 
-@dataclass(frozen=True)
-class Episode:
-    order: int
-    uuid: str
-    url: furl
-    title: str
-    podcast: str
-
-    @classmethod
-    def from_dict(cls, order: int, dict: t.Dict) -> "Episode":
-        input_dict = dict.copy()
-        input_dict["order"] = order
-        args = {field.name: field.type(input_dict[field.name]) for field in fields(cls)}
-        return cls(**args)
-
-    @property
-    def extension(self) -> str:
-        return Path(self.url.path.segments[-1]).suffix
-
-    @property
-    def filename(self) -> str:
-        return f"{self.uuid}{self.extension}"
-
-    @property
-    def path(self):
-        return MUSIC_DIR / self.filename
-   
-    @property
-    def duration(self) -> int:
-        return int(MP3(self.path).info.length)
-    
-
-@dataclass
-class PocketCasts:
-    session: requests.Session
-
-    def json(self, method: str, *args, **kwargs) -> t.Dict:
-        method_call = getattr(self.session, method)
-        with method_call(*args, **kwargs) as response:
-            return response.json()
-
-    def up_next(self) -> t.List[Episode]:
-        response = self.json("post", "https://api.pocketcasts.com/up_next/list", json={"version": 2})
-        return [Episode.from_dict(*item) for item in enumerate(response["episodes"])]
-
-    def podcasts(self) -> t.Dict[str, str]:
-        response = self.json("post", "https://api.pocketcasts.com/user/podcast/list", json={"v": 1})
-        return {podcast['uuid']: podcast['title'] for podcast in response['podcasts']}
-
-
-@contextmanager
-def pocket_casts():
-    with requests.Session() as session:
-        with session.post('https://api.pocketcasts.com/user/login',
-                          json={"email": USERNAME, "password": PASSWORD}) as response:
-            content = response.json()
-            token = content["token"]
-        session.headers.update({"Authorization": f"Bearer {token}"})
-        yield PocketCasts(session)
-
-
-def speedup(input: str, output: str) -> None:
-    options = {}
+async def warm_connection(session: aiohttp.ClientSession, origin: str) -> None:
     try:
-        options['audio_bitrate'] = ffmpeg.probe(input)['format']['bit_rate']
-    except Exception:
+        async with session.head(origin, allow_redirects=False, timeout=aiohttp.ClientTimeout(total=2)):
+            pass
+    except (aiohttp.ClientError, asyncio.TimeoutError):
         pass
 
-    (
-        ffmpeg.input(input)
-        .audio
-        .filter_('atempo', '1.3')
-        .output(output, **options)
-        .run(quiet=True)
-    )
-
 
-def download_episode(episode: Episode) -> t.Tuple[bool, Episode]:
+async def download_episode_async(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                                 encoder: Executor, episode: Episode, tempo: float) -> t.Tuple[bool, Episode]:
     try:
-        contents = requests.get(str(episode.url)).content
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            input_filename = temp_file.name
-            temp_file.write(contents)
-
-        speedup(input_filename, str(episode.path.resolve()))
+        loop = asyncio.get_running_loop()
+        with ExitStack() as cleanup:
+            async with semaphore:
+                # Only create the staging file once a download slot is free; it outlives the slot
+                # so the encode below doesn't hold one
+                temp_file = cleanup.enter_context(staging_file(episode))
+                async with session.get(episode.url) as response:
+                    response.raise_for_status()
+                    async for chunk in response.content.iter_chunked(1 << 16):
+                        await loop.run_in_executor(None, temp_file.write, chunk)
+            temp_file.close()
+
+            if tempo == 1.0:
+                os.replace(temp_file.name, episode.path)
+            else:
+                await loop.run_in_executor(encoder, speedup, temp_file.name, str(episode.partial_path), tempo)
+                os.replace(episode.partial_path, episode.path)
 
     except Exception:
         log.exception("Error downloading or speeding up %s", episode.url)
         return False, episode
 
-    finally:
-        try:
-            os.unlink(input_filename)
-        except Exception:
-            pass
-
     return True, episode
 
 
-def sync():
-    with pocket_casts() as api:
+async def download_episodes(episodes_to_download: t.List[Episode], titles_by_uuid: t.Dict[str, str],
+                            tempo: float) -> None:
+    semaphore = asyncio.Semaphore(4)
+    connector = aiohttp.TCPConnector(limit=8, limit_per_host=4, keepalive_timeout=60)
+    # Large episodes can take well over aiohttp's default 5 minute total, so only time out stalled sockets
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    # ffmpeg does the encoding in its own process, so threads are enough to bound how many run at once
+    with ThreadPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) // 2)) as encoder, \
+            ThreadPoolExecutor(max_workers=2) as tagger:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            # Warm a connection to each host in the background, so episodes still queued behind the
+            # semaphore find an open socket without delaying the first downloads
+            origins = {
+                f"{url.scheme}://{url.netloc}/"
+                for url in (urlsplit(episode.url) for episode in episodes_to_download)
+            }
+            warmups = [asyncio.create_task(warm_connection(session, origin)) for origin in origins]
+
+            try:
+                downloads = [download_episode_async(session, semaphore, encoder, episode, tempo)
+                             for episode in episodes_to_download]
+                for download in asyncio.as_completed(downloads):
+                    success, episode = await download
+                    if success:
+                        log.info("Downloaded %s: %s", episode.title, episode.filename)
+                        album = titles_by_uuid.get(episode.podcast, "Mystery podcast")
+                        tagger.submit(tag_episode, episode, album)
+            finally:
+                for warmup in warmups:
+                    warmup.cancel()
+                await asyncio.gather(*warmups, return_exceptions=True)
+
+
+def sync(tempo: float) -> t.Dict[str, Episode]:
+    with pocket_casts(USERNAME, PASSWORD, MUSIC_DIR) as api:
         # Get all podcast titles
         titles_by_uuid: t.Dict[str, str] = api.podcasts()
 
@@ -162,16 +132,20 @@ def sync():
         }
 
         # Get previously-downloaded files
-        ipod_by_uuid: t.Dict[str, Path] = {}
+        ipod_by_uuid: t.Dict[str, str] = {}
         playlist_path = MUSIC_DIR
         playlist_path.mkdir(parents=True, exist_ok=True)
-        filename_regex = re.compile(r"([a-f0-9-]+)\..+")
-        for file in playlist_path.iterdir():
-            filename_match = filename_regex.match(file.name)
-            if not filename_match:
-                log.error("Cannot parse filename %s", file)
+        for filename in playlist_filenames(playlist_path, use_find=True):
+            if filename.startswith("."):
+                # Clean up after downloads that were interrupted mid-sync
+                if filename.startswith(STAGING_PREFIX):
+                    (playlist_path / filename).unlink()
                 continue
-            ipod_by_uuid[filename_match.group(1)] = file
+            uuid = Episode.uuid_from_filename(filename)
+            if not uuid:
+                log.error("Cannot parse filename %s", filename)
+                continue
+            ipod_by_uuid[uuid] = filename
 
 
         uuids_on_ipod = set(ipod_by_uuid.keys())
@@ -181,32 +155,18 @@ def sync():
         uuids_to_download = uuids_from_pocketcasts - uuids_on_ipod
 
         for uuid in uuids_to_delete:
-            ipod_by_uuid[uuid].unlink()
+            (playlist_path / ipod_by_uuid[uuid]).unlink()
 
         episodes_to_download = [pocketcasts_by_uuid[uuid] for uuid in uuids_to_download]
 
         if episodes_to_download:
             log.info("Downloading %r", [episode.title for episode in episodes_to_download])
-        with ThreadPool() as pool:
-            for success, episode in pool.imap_unordered(download_episode, episodes_to_download):
-                if success:
-                    log.info("Downloaded %s: %s", episode.title, episode.filename)
-                    try:
-                        tags = EasyID3(episode.path)
-                        tags["title"] = episode.title
-                        tags["genre"] = "Podcast"
-                        try:
-                            tags["album"] = titles_by_uuid[episode.podcast]
-                        except KeyError:
-                            tags["album"] = "Mystery podcast"
-                        tags.save()
-                    except Exception:
-                        log.exception("Could not rename %r", episode)
+            asyncio.run(download_episodes(episodes_to_download, titles_by_uuid, tempo))
 
         return pocketcasts_by_uuid
 
 
-episodes = sync()
+episodes: t.Dict[str, Episode] = {}
 
 
 def auth(f):
@@ -219,23 +179,27 @@ def auth(f):
     return inner
 
 
+SUBSONIC_STATUS = {
+    "status": "ok",
+    "version": "1.10.2",
+}
+EMPTY_RESPONSE = orjson.dumps({"subsonic-response": SUBSONIC_STATUS})
+
+
 def make_response(dict):
     return {
-      "subsonic-response": {
-            "status": "ok",
-            "version": "1.10.2",
-        } | dict,
+        "subsonic-response": {**SUBSONIC_STATUS, **dict},
     }
 
 
 @app.route('/rest/ping')
 def ping():
-    return make_response({})
+    return Response(EMPTY_RESPONSE, mimetype="application/json")
 
 
 @app.route('/rest/scrobble')
 def scrobble():
-    return make_response({})
+    return Response(EMPTY_RESPONSE, mimetype="application/json")
 
 
 @app.route('/rest/getPlaylists')
@@ -254,6 +218,7 @@ def get_playlists():
 
 
 @app.route('/rest/getPlaylist')
+@cache.cached(timeout=300, query_string=True)
 def get_playlist():
     if not (playlist_id := request.args.get('id')):
         abort(400)
@@ -283,4 +248,17 @@ def stream():
     if not (episode_id := request.args.get('id')):
         abort(400)
 
-    return send_file(episodes[episode_id].path)
+    return send_episode(episodes[episode_id], request)
+
+
+@click.command()
+@click.option('--tempo', '-t', type=click.FloatRange(0.5, 2.0), default=1.0, show_default=True,
+              help='Speed up (or slow down) episodes by this factor with ffmpeg.')
+def main(tempo: float) -> None:
+    global episodes
+    episodes = sync(tempo)
+    app.run(host='0.0.0.0', port=5000)
+
+
+if __name__ == '__main__':
+    main()